@@ -2,10 +2,12 @@ import glob
 import json
 import ntpath
 import os
+import re
 import readline
 import shutil
 import subprocess
 from datetime import datetime
+from itertools import chain, islice
 from json import JSONDecodeError
 from pathlib import Path
 from shlex import split
@@ -50,6 +52,13 @@ class TezosClient:
 class Tzc:
     nft_path = './nft.tzc.json'
     export_path = './account.tzc.json'
+    jobs_path = './jobs.tzc/'
+    # Operations can't be included more than max_operations_ttl (120) blocks after their branch
+    job_check_previous = 120
+    job_check_timeout = 180
+
+
+OPERATION_HASH_PATTERN = re.compile(r"Operation hash is '(\w+)'")
 
 
 def safe_json_read_array(path):
@@ -84,14 +93,70 @@ def echo_obj(elems, **kwargs):
     click.echo(res)
 
 
-def stream_command(command):
+def select_entries(entries, pattern=None, offset=0, limit=None, keys=('name', 'value')):
+    """Lazily keep the entries whose keys match the given pattern, then slice the result"""
+    if pattern:
+        try:
+            regex = re.compile(pattern)
+        except re.error:
+            regex = re.compile(re.escape(pattern))
+        entries = (e for e in entries
+                   if any(regex.search(str(e[k])) for k in keys))
+    return islice(entries, offset, offset + limit if limit is not None else None)
+
+
+def echo_entries(entries, table, row, line, as_json=False, pager=False, empty_msg='No entries'):
+    """Print the entries as JSON lines, through a pager or as a rich table"""
+    if as_json and pager:
+        raise click.UsageError('--json and --pager cannot be used together')
+    if as_json:
+        for e in entries:
+            click.echo(json.dumps(e))
+    elif pager:
+        entries = iter(entries)
+        first = next(entries, None)
+        if first is None:
+            rich.print(f":person_shrugging: [i]{empty_msg}[/i]")
+        else:
+            click.echo_via_pager(line(e) + '\n' for e in chain([first], entries))
+    else:
+        for e in entries:
+            table.add_row(*row(e))
+        if table.rows:
+            rich.print(table)
+        else:
+            rich.print(f":person_shrugging: [i]{empty_msg}[/i]")
+
+
+def listing_options(filter_help):
+    """Add the filtering, pagination and output options shared by the show commands"""
+    options = [
+        option('--filter', 'pattern', help=filter_help),
+        option('--offset', type=click.IntRange(min=0), default=0, help='Skip the first matching entries'),
+        option('--limit', type=click.IntRange(min=0), help='Show at most this number of entries'),
+        option('--json', 'as_json', is_flag=True, help='Stream the entries as JSON lines'),
+        option('--pager', is_flag=True, help='Render the entries lazily through a pager'),
+    ]
+
+    def decorator(f):
+        for o in reversed(options):
+            f = o(f)
+        return f
+
+    return decorator
+
+
+def stream_command(command, on_output=None):
     process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     while True:
         output = process.stdout.readline()
         if not output and process.poll() is not None:
             break
         if output:
-            rich.print(output.decode("utf-8").rstrip())
+            line = output.decode("utf-8").rstrip()
+            rich.print(line)
+            if on_output:
+                on_output(line)
     rc = process.poll()
 
     if rc:
@@ -316,19 +381,18 @@ def account_import(alias, verbose, force):
 
 
 @account.command(name="show")
-def account_show():
+@listing_options('Only show the accounts whose alias or address matches this regex')
+def account_show(pattern, offset, limit, as_json, pager):
     """List configured accounts usable by the client."""
     accounts = safe_json_read_array(TezosClient.public_keys_hashs_path)
 
     table = Table(title="Known accounts")
     table.add_column("Alias", justify="right")
     table.add_column("Address", justify="left")
-    for a in accounts:
-        table.add_row(a['name'], a['value'])
-    if table.rows:
-        rich.print(table)
-    else:
-        rich.print(f":person_shrugging: [i]No accounts [/i]")
+    echo_entries(select_entries(accounts, pattern, offset, limit), table,
+                 row=lambda a: (a['name'], a['value']),
+                 line=lambda a: f"{a['name']}\t{a['value']}",
+                 as_json=as_json, pager=pager, empty_msg='No accounts ')
 
 
 @account.command(name="snap", help="Make a copy of your existing accounts in your tezos-client base directory")
@@ -440,8 +504,8 @@ def get_tzc_config_entry_by_account_name(tzc_config_file_path, name):
     return
 
 
-def michelson_mint_nft_paramaters(owner_name, nft_tzc_name, token_id):
-    """Generate the mint michelson parameter"""
+def michelson_mint_nft_paramaters(owner_name, nft_tzc_name, token_ids):
+    """Generate the mint michelson parameter of each token id"""
     nfts = safe_json_read_object('./nft.tzc.json')
     if nft_tzc_name in nfts.keys():
         nft = nfts[nft_tzc_name]
@@ -454,11 +518,10 @@ def michelson_mint_nft_paramaters(owner_name, nft_tzc_name, token_id):
         elements.append(f'Elt "{attr}" {hexValue}')
 
     #  (pair (map %metadata string bytes) (nat %token_id)))
-    token_info = '(Pair {' + '; '.join(elements) + '} ' + str(token_id) + ')'
+    metadata = '{' + '; '.join(elements) + '}'
     owner_address = find_first_account_by_name(owner_name)['value']
-    mint_params = f'(Pair (Pair "{owner_address}" 1) {token_info} )'
 
-    return mint_params
+    return [f'(Pair (Pair "{owner_address}" 1) (Pair {metadata} {token_id}) )' for token_id in token_ids]
 
 
 @tzc.group(name="contract")
@@ -473,24 +536,25 @@ def get_contract_names():
 
 @contract.command(name="show")
 @option("--alias", help="Show the contract address for the given alias")
-def contract_show(alias):
+@listing_options('Only show the contracts whose alias or address matches this regex')
+def contract_show(alias, pattern, offset, limit, as_json, pager):
     """List known contracts alias and address"""
 
     contracts = safe_json_read_array(TezosClient.contracts_path)
 
     if alias:
-        c = next((x for x in contracts if x['name'] == alias))
+        c = next((x for x in contracts if x['name'] == alias), None)
         if c:
             return click.echo(c['value'])
+        echo_invalid(f"Unknown contract alias={alias}")
+        return click.get_current_context().exit(1)
     table = Table(title="Known contracts")
     table.add_column("Alias", justify="right")
     table.add_column("Address", justify="left")
-    for c in contracts:
-        table.add_row(c['name'], c['value'])
-    if table.rows:
-        rich.print(table)
-    else:
-        rich.print(f":person_shrugging: [i]No accounts [/i]")
+    echo_entries(select_entries(contracts, pattern, offset, limit), table,
+                 row=lambda c: (c['name'], c['value']),
+                 line=lambda c: f"{c['name']}\t{c['value']}",
+                 as_json=as_json, pager=pager, empty_msg='No contracts ')
 
 
 @contract.command(name="add")
@@ -581,7 +645,9 @@ def nft():
 @option('--owner', help='The account that will own the NFT')
 @option('--nft-alias', help='The NFT alias to mint')
 @option('--token-id', help='The NFT token id')
-def nft_mint(contract, admin, owner, nft_alias, token_id):
+@option('--count', type=click.IntRange(min=1), default=1,
+        help='Number of NFTs to mint, with consecutive token ids starting from --token-id')
+def nft_mint(contract, admin, owner, nft_alias, token_id, count):
     """Mint NFT for a given contract"""
     contract_names = get_contract_names()
     if contract and contract not in contract_names:
@@ -611,14 +677,16 @@ def nft_mint(contract, admin, owner, nft_alias, token_id):
     if not token_id:
         token_id = int(prompt('Token Id: '))
 
-    args = michelson_mint_nft_paramaters(owner, nft_alias, token_id)
-
-    stream_command(["tezos-client", "call", contract,
-                    "from", admin,
-                    "--entrypoint", "mint",
-                    "--arg", args,
-                    "--burn-cap", str(0.5)
-                    ])
+    token_ids = range(int(token_id), int(token_id) + count)
+    commands = [["tezos-client", "call", contract,
+                 "from", admin,
+                 "--entrypoint", "mint",
+                 "--arg", args,
+                 "--burn-cap", str(0.5)
+                 ] for args in michelson_mint_nft_paramaters(owner, nft_alias, token_ids)]
+    job_id = new_job_id('nft-mint')
+    job_plan(job_id, commands)
+    job_execute_and_report(job_id, False)
 
 
 @nft.command(name='transfer')
@@ -647,47 +715,251 @@ def nft_transfer(contract, contract_admin, prev_owner, next_owner, token_id):
 
     yes_no_completer = WordCompleter(['y', 'n'])
 
+    def transfer_command(transfers):
+        return ["tezos-client",
+                "call", contract,
+                "from", contract_admin,
+                "--entrypoint", "transfer",
+                "--arg", '{' + '; '.join(transfers) + '}',
+                "--burn-cap", str(0.5)
+                ]
+
+    job_id = new_job_id('nft-transfer')
     transfers = []
     if prev_owner and next_owner and token_id:
         # TODO Handle alias
         transfers.append(f'Pair "{prev_owner}" {{Pair "{next_owner}" (Pair {token_id} 1) }}')
+        job_plan(job_id, [transfer_command(transfers)])
     else:
+        # The batch is journaled again each time a transfer is entered, so that an interrupted session can be resumed
         add_transfer = True
-        while add_transfer:
-            from_account = prompt('From (account or literal): ', completer=WordCompleter(account_names))
-            if from_account in account_names:
-                from_account = find_first_account_by_name(from_account)['value']
-
-            to_account = prompt('To (account or literal): ', completer=WordCompleter(account_names))
-            if to_account in account_names:
-                to_account = find_first_account_by_name(to_account)['value']
-            token_id = int(prompt("Token ID: "))
-
-            qty = int(prompt("Quantity: ", default='1'))
-            transfers.append(f'Pair "{from_account}" {{Pair "{to_account}" (Pair {token_id} {qty}) }}')
-            add_transfer = prompt('Transfer another (y/n) ?', completer=yes_no_completer) == 'y'
+        try:
+            while add_transfer:
+                from_account = prompt('From (account or literal): ', completer=WordCompleter(account_names))
+                if from_account in account_names:
+                    from_account = find_first_account_by_name(from_account)['value']
+
+                to_account = prompt('To (account or literal): ', completer=WordCompleter(account_names))
+                if to_account in account_names:
+                    to_account = find_first_account_by_name(to_account)['value']
+                token_id = int(prompt("Token ID: "))
+
+                qty = int(prompt("Quantity: ", default='1'))
+                transfers.append(f'Pair "{from_account}" {{Pair "{to_account}" (Pair {token_id} {qty}) }}')
+                job_plan(job_id, [transfer_command(transfers)])
+                add_transfer = prompt('Transfer another (y/n) ?', completer=yes_no_completer) == 'y'
+        except KeyboardInterrupt:
+            if transfers:
+                echo_invalid(f"Interrupted, run the {len(transfers)} planned transfers with "
+                             f"`clk tzc job resume --job {job_id}`")
+            return
 
-    args = '{' + '; '.join(transfers) + '}'
-    stream_command(["tezos-client",
-                    "call", contract,
-                    "from", contract_admin,
-                    "--entrypoint", "transfer",
-                    "--arg", args,
-                    "--burn-cap", str(0.5)
-                    ])
+    job_execute_and_report(job_id, False)
 
 
 @nft.command(name='show')
-def nft_show():
+@listing_options('Only show the NFTs whose alias matches this regex')
+def nft_show(pattern, offset, limit, as_json, pager):
     """Show the known TZC nft templates"""
     nfts = safe_json_read_object(Tzc.nft_path)
     table = Table(title="Known NFTs")
     table.add_column("Alias", justify="right")
     table.add_column("Metadata", justify="left")
 
-    for name in nfts:
-        table.add_row(name, Pretty(nfts[name]))
+    entries = ({'name': name, 'metadata': nfts[name]} for name in nfts)
+    echo_entries(select_entries(entries, pattern, offset, limit, keys=('name',)), table,
+                 row=lambda n: (n['name'], Pretty(n['metadata'])),
+                 line=lambda n: f"{n['name']}\t{json.dumps(n['metadata'])}",
+                 as_json=as_json, pager=pager, empty_msg=f'No NFTs found at {Tzc.nft_path}')
+
+
+def job_journal_path(job_id):
+    return os.path.join(Tzc.jobs_path, job_id + '.jsonl')
+
+
+def job_append(job_id, *records):
+    """Durably append the given records to the journal of the job"""
+    with open(job_journal_path(job_id), 'a') as f:
+        for record in records:
+            # Leading newline so that a record truncated by a crash never swallows the next one
+            f.write('\n' + json.dumps(record))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def job_state(job_id):
+    """Replay the journal of the job, returning its items indexed by position"""
+    items = {}
+    with open(job_journal_path(job_id)) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except JSONDecodeError:
+                LOGGER.debug(f"Skipping truncated journal record of job={job_id}")
+                continue
+            if 'command' in record:
+                # A planned command starts the item afresh, it never inherits the state of a previous one
+                items[record['index']] = record
+            else:
+                items.setdefault(record['index'], {}).update(record)
+    return items
+
+
+def job_plan(job_id, commands):
+    """Record the given tezos-client commands as planned items of the job"""
+    os.makedirs(Tzc.jobs_path, exist_ok=True)
+    job_append(job_id, *({'index': index, 'command': command, 'status': 'planned'}
+                         for index, command in enumerate(commands)))
+
+
+def new_job_id(prefix):
+    return f"{prefix}-{datetime.now().strftime('%Y-%m-%dT%H%M%S.%f')}-{os.getpid()}"
+
+
+def get_job_ids():
+    if not os.path.isdir(Tzc.jobs_path):
+        return []
+    return sorted(name[:-len('.jsonl')] for name in os.listdir(Tzc.jobs_path) if name.endswith('.jsonl'))
+
+
+def operation_included(operation_hash, check_previous):
+    """Tell whether the operation is included in the previous blocks
+
+    Without its branch, tezos-client keeps watching new heads for an operation that was dropped, so the check gives
+    up after Tzc.job_check_timeout seconds.
+    """
+    try:
+        return not subprocess.run(['tezos-client', 'wait', 'for', operation_hash, 'to', 'be', 'included',
+                                   '--check-previous', str(check_previous)],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                  timeout=Tzc.job_check_timeout).returncode
+    except subprocess.TimeoutExpired:
+        LOGGER.debug(f"Gave up waiting for operation={operation_hash}")
+        return False
+
+
+def job_execute(job_id, keep_going, check_previous=Tzc.job_check_previous, retry_unconfirmed=False):
+    """Run the items of the job which are not applied yet, returning the number of failed items
+
+    An item whose operation hash has been recorded is never submitted again until its inclusion has been checked.
+    When it can't be found it is marked unconfirmed, and only resent with retry_unconfirmed.
+    """
+    items = job_state(job_id)
+    failed = 0
+    for index in sorted(items):
+        item = items[index]
+        if item['status'] == 'applied':
+            continue
+        if item['status'] == 'unconfirmed' and retry_unconfirmed:
+            job_append(job_id, {'index': index, 'status': 'planned', 'hash': None})
+            item['hash'] = None
+
+        if item.get('hash'):
+            rc = 0 if operation_included(item['hash'], check_previous) else 1
+            status = 'unconfirmed' if rc else 'applied'
+            if rc:
+                echo_invalid(f"Operation {item['hash']} of item {index} is unconfirmed, make sure it did not land "
+                             f"before resuming the job with --retry-unconfirmed")
+        else:
+            def on_output(line, index=index, item=item):
+                match = OPERATION_HASH_PATTERN.search(line)
+                if match:
+                    item['hash'] = match.group(1)
+                    job_append(job_id, {'index': index, 'status': 'submitted', 'hash': item['hash']})
+
+            rc = stream_command(item['command'], on_output)
+            # Once injected, a failure may only be a confirmation timeout: the operation can still land
+            status = 'applied' if not rc else 'unconfirmed' if item.get('hash') else 'failed'
+        job_append(job_id, {'index': index, 'status': status})
+        if rc:
+            failed += 1
+            if not keep_going:
+                break
+    return failed
+
+
+def job_execute_and_report(job_id, *args):
+    """Run the job and print its progress, even when interrupted"""
+    try:
+        failed = job_execute(job_id, *args)
+    except KeyboardInterrupt:
+        echo_invalid(f"Job {job_id} interrupted")
+        failed = 1
+    echo_job_result(job_id, failed)
+
+
+def echo_job_result(job_id, failed):
+    items = job_state(job_id)
+    applied = sum(1 for item in items.values() if item['status'] == 'applied')
+    if failed or applied < len(items):
+        echo_invalid(f"Job {job_id}: {applied}/{len(items)} applied, "
+                     f"resume it with `clk tzc job resume --job {job_id}`")
+    else:
+        rich.print(f"[bold green]:heavy_check_mark: [/bold green] Job {job_id}: {applied}/{len(items)} applied")
+
+
+@tzc.group()
+def job():
+    """Run bulk tezos-client operations through a resumable journal"""
+
+
+@job.command(name='run')
+@option('--file', help='JSON array of tezos-client commands, either as strings or as lists of arguments')
+@option('--name', help='The job name, defaults to the current timestamp')
+@option('--keep-going', is_flag=True, help='Run the remaining operations after a failure')
+def job_run(file, name, keep_going):
+    """Plan and run a bulk sequence of operations"""
+    if not file:
+        readline.set_completer_delims(' \t\n;')
+        readline.parse_and_bind("tab: complete")
+        readline.set_completer(path_complete)
+        file = raw_input('Commands file > ')
+    job_id = name or datetime.now().strftime("%Y-%m-%dT%H%M%S")
+    if job_id in get_job_ids():
+        echo_invalid(f"The job {job_id} already exists, use `clk tzc job resume --job {job_id}`")
+        return
+
+    commands = safe_json_read_array(file)
+    job_plan(job_id, [split(command) if isinstance(command, str) else command for command in commands])
+    job_execute_and_report(job_id, keep_going)
+
+
+@job.command(name='resume')
+@option('--job', 'job_id', help='The job to resume')
+@option('--keep-going', is_flag=True, help='Run the remaining operations after a failure')
+@option('--check-previous', type=click.IntRange(min=1), default=Tzc.job_check_previous,
+        help='Number of previous blocks searched for the operations submitted by a previous run, '
+             'increase it when resuming long after the interruption')
+@option('--retry-unconfirmed', is_flag=True,
+        help='Resend the unconfirmed operations, only once you made sure they did not land')
+def job_resume(job_id, keep_going, check_previous, retry_unconfirmed):
+    """Skip the applied operations of a job and retry the rest"""
+    job_ids = get_job_ids()
+    if not job_ids:
+        rich.print(f":person_shrugging: [i]No jobs found at {Tzc.jobs_path}[/i]")
+        return
+    if job_id and job_id not in job_ids:
+        echo_invalid(f"Unknown job={job_id}")
+        job_id = None
+    if not job_id:
+        job_id = tzc_prompt('Job > ', job_ids)
+    job_execute_and_report(job_id, keep_going, check_previous, retry_unconfirmed)
+
+
+@job.command(name='show')
+def job_show():
+    """Show the known jobs and their progress"""
+    table = Table(title="Known jobs")
+    table.add_column("Job", justify="right")
+    job_statuses = ('planned', 'submitted', 'applied', 'unconfirmed', 'failed')
+    for status in job_statuses:
+        table.add_column(status.capitalize(), justify="right")
+    for job_id in get_job_ids():
+        statuses = [item['status'] for item in job_state(job_id).values()]
+        table.add_row(job_id, *(str(statuses.count(status)) for status in job_statuses))
     if table.rows:
         rich.print(table)
     else:
-        rich.print(f":person_shrugging: [i]No NFTs found at {Tzc.nft_path}[/i]")
+        rich.print(f":person_shrugging: [i]No jobs found at {Tzc.jobs_path}[/i]")